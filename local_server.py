@@ -1,7 +1,12 @@
+import logging
+
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse
 from src.app import lambda_handler
 
+logging.basicConfig(level=logging.WARNING)
+
 app = FastAPI()
 
 
@@ -30,7 +35,9 @@ def build_event(request: Request, body_text: str = "") -> dict:
 @app.api_route("/{path:path}", methods=["GET", "OPTIONS"])
 async def proxy(path: str, request: Request):
     event = build_event(request)
-    result = lambda_handler(event, None)
+    # OpenSky取得中にイベントループを塞がないようスレッドで実行する
+    # （同時リクエストのキャッシュ更新は src/app.py 側のロックで1回にまとまる）
+    result = await run_in_threadpool(lambda_handler, event, None)
 
     status_code = result.get("statusCode", 200)
     headers = result.get("headers", {})
@@ -39,9 +46,9 @@ async def proxy(path: str, request: Request):
     content_type = headers.get("Content-Type", headers.get("content-type", ""))
 
     if "application/json" in content_type:
-        import json
-        return JSONResponse(
-            content=json.loads(body) if body else None,
+        # Lambda側でエンコード済みのbodyをそのまま返す（再パース・再エンコードしない）
+        return Response(
+            content=body,
             status_code=status_code,
             headers=headers,
         )
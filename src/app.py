@@ -1,36 +1,90 @@
 # src/app.py
-import json
+import gzip
+import logging
 import os
+import threading
+import time
 from pathlib import Path
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+
+import orjson
+import urllib3
+from urllib3.util.retry import Retry
 
 OPENSKY_URL = "https://opensky-network.org/api/states/all"
 
+logger = logging.getLogger(__name__)
+
 BASE_DIR = Path(__file__).resolve().parent
-SNAPSHOT_PATH = BASE_DIR / "opensky_states_snapshot.json"
+# snapshotはgzip圧縮したJSON
+SNAPSHOT_PATH = BASE_DIR / "opensky_states_snapshot.json.gz"
 INDEX_PATH = BASE_DIR / "static" / "index.html"
 
+# Lambdaのウォーム起動間でTLS接続を使い回すため、モジュールレベルで保持
+_HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=16,
+    # gzipはurllib3がレスポンス読み込み時に自動で展開する
+    headers={"User-Agent": "air-traffic-tracker/0.1", "Accept-Encoding": "gzip"},
+    # Lambdaのタイムアウト(30秒)内にsnapshotへフォールバックできるよう、
+    # 1回あたり最大10秒・読み込みタイムアウトは再試行しない（最悪でも約20秒）
+    retries=Retry(total=1, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+OPENSKY_TIMEOUT = urllib3.Timeout(total=10, connect=3, read=8)
+
+# OpenSkyのレスポンスキャッシュ（/planes と /track で共有）
+# 有効期限はレスポンスの time（OpenSky側の取得時刻）+ OPENSKY_UPDATE_SEC を基準に、
+# 取得時点から [CACHE_MIN_TTL_SEC, CACHE_TTL_SEC] の範囲に収める
+OPENSKY_UPDATE_SEC = 10
+CACHE_MIN_TTL_SEC = 5
+CACHE_TTL_SEC = 30
+_cache_lock = threading.Lock()
+_cached: tuple[dict, dict[str, tuple], float] | None = None  # (data, icao24_index, 有効期限)
+# 取得失敗後はこの時刻まで OpenSky に再アクセスしない
+FAILURE_BACKOFF_SEC = 10
+_failed_until = 0.0
+
+# 読み込み済みsnapshotとそのインデックス（ウォーム起動間で使い回す）
+_snapshot: tuple[dict, dict[str, tuple]] | None = None
+
+# UIのHTMLは起動時に1回だけ読み込む
+# 見つからない場合のプレースホルダはキャッシュさせない
+try:
+    _INDEX_HTML = INDEX_PATH.read_text(encoding="utf-8")
+    _INDEX_CACHE_CONTROL = "public, max-age=300"
+except FileNotFoundError:
+    _INDEX_HTML = "<h1>Flight Tracker</h1><p>static/index.html not found</p>"
+    _INDEX_CACHE_CONTROL = "no-store"
+
+# 正常系の /planes /track はCDNで短時間キャッシュさせる（エラーは no-store のまま）
+STATES_CACHE_CONTROL = "public, s-maxage=15, stale-while-revalidate=60"
+
+# 取得失敗時のフォールバック（stale / snapshot）はキャッシュさせない
+# （FORCE_SNAPSHOT で常にsnapshotを返す構成はキャッシュしてよい）
+def _states_cache_control(source: str) -> str:
+    if source == "live" or os.getenv("FORCE_SNAPSHOT") == "1":
+        return STATES_CACHE_CONTROL
+    return "no-store"
+
 # JSON用
-def _resp_json(status: int, obj) -> dict:
+def _resp_json(status: int, obj, cache_control: str = "no-store") -> dict:
     return {
         "statusCode": status,
         "headers": {
             "Content-Type": "application/json; charset=utf-8",
-            "Cache-Control": "no-store",
+            "Cache-Control": cache_control,
             "Access-Control-Allow-Origin": "https://d1nej4xkg5qji4.cloudfront.net",
             "Access-Control-Allow-Methods": "GET,OPTIONS",
             "Access-Control-Allow-Headers": "Content-Type"
         },
-        "body": json.dumps(obj, ensure_ascii=False),
+        "body": orjson.dumps(obj).decode("utf-8"),
     }
 
 # HTML用
-def _resp_html(status: int, html: str) -> dict:
+def _resp_html(status: int, html: str, cache_control: str = "no-store") -> dict:
     return {
         "statusCode": status,
         "headers": {"Content-Type": "text/html; charset=utf-8", 
-                    "Cache-Control": "no-store",
+                    "Cache-Control": cache_control,
                     "Access-Control-Allow-Origin": "https://d1nej4xkg5qji4.cloudfront.net",
                     "Access-Control-Allow-Methods": "GET,OPTIONS",
                     "Access-Control-Allow-Headers": "Content-Type"
@@ -38,86 +92,134 @@ def _resp_html(status: int, html: str) -> dict:
         "body": html,
     }
 
-# snapshotからデータ取得
-def load_snapshot() -> dict:
-    if SNAPSHOT_PATH.exists():
-        return json.loads(SNAPSHOT_PATH.read_text(encoding="utf-8"))
-    return {"time": None, "states": []}
+# snapshotからデータ取得（初回のみファイルを読み込む）
+def load_snapshot() -> tuple[dict, dict[str, tuple]]:
+    # 戻り値: (data, icao24_index)
+    global _snapshot
+
+    if _snapshot is None:
+        if SNAPSHOT_PATH.exists():
+            data = compact_states(orjson.loads(gzip.decompress(SNAPSHOT_PATH.read_bytes())))
+        else:
+            data = {"time": None, "states": []}
+        _snapshot = (data, build_icao24_index(data))
+    return _snapshot
+
+# 使わないフィールド（sensors, squawk, spi, position_source）を落としてから保持する
+# 並び: [icao24, callsign, origin_country, time_position, last_contact, lon, lat, baro_altitude, on_ground, velocity, heading, vertical_rate, geo_altitude]
+def compact_states(data: dict) -> dict:
+    states = [
+        (s[0], s[1], s[2], s[3], s[4], s[5], s[6], s[7], s[8], s[9], s[10], s[11], s[13])
+        for s in data.get("states") or []
+    ]
+    return {"time": data.get("time"), "states": states}
+
+# icao24(小文字) -> state のインデックスを作成（同じicao24は先勝ち）
+def build_icao24_index(data: dict) -> dict[str, tuple]:
+    index = {}
+    for s in data.get("states") or []:
+        if s[0]:
+            index.setdefault(s[0].lower(), s)
+    return index
+
+# キャッシュの有効期限（epoch秒）を計算
+def _cache_expiry(data: dict, now: float) -> float:
+    data_time = data.get("time") or now
+    expiry = data_time + OPENSKY_UPDATE_SEC
+    return min(max(expiry, now + CACHE_MIN_TTL_SEC), now + CACHE_TTL_SEC)
+
+# OpenSky取得失敗時の返却値（前回のliveデータがあればsnapshotより優先する）
+def _fallback(cached: tuple | None) -> tuple[dict, dict[str, tuple], str]:
+    if cached is not None:
+        data, index, _ = cached
+        age = int(time.time() - (data.get("time") or time.time()))
+        return data, index, f"stale(age={age}s)"
+    return (*load_snapshot(), "snapshot")
 
 # OpenSkyからデータ取得
-def fetch_opensky_or_snapshot(timeout_sec: int = 12) -> tuple[dict, str]:
-    # 戻り値: (data, source)  source = "live" or "snapshot"
+def fetch_opensky_or_snapshot(timeout: urllib3.Timeout = OPENSKY_TIMEOUT) -> tuple[dict, dict[str, tuple], str]:
+    # 戻り値: (data, icao24_index, source)  source = "live" / "stale(age=Ns)" / "snapshot"
+    global _cached, _failed_until
 
     if os.getenv("FORCE_SNAPSHOT") == "1":
-        return load_snapshot(), "snapshot"
+        return (*load_snapshot(), "snapshot")
 
-    try:
-        req = Request(OPENSKY_URL, headers={"User-Agent": "air-traffic-tracker/0.1"})
-        with urlopen(req, timeout=timeout_sec) as r:
-            raw = r.read().decode("utf-8")
-            data = json.loads(raw)
-            return data, "live"
-        
-    except Exception as e:
-        print(f"[WARN] OpenSky failed -> snapshot fallback: {type(e).__name__}: {e}")
-        return load_snapshot(), "snapshot"
+    # data / index / 有効期限は1つのタプルで持ち、常に同じ世代を参照する
+    cached = _cached
+    if cached is not None and time.time() < cached[2]:
+        return cached[0], cached[1], "live"
+    if time.time() < _failed_until:
+        return _fallback(cached)
+
+    with _cache_lock:
+        # ロック待ちの間に別リクエストが更新済み（または取得失敗済み）ならそれを使う
+        cached = _cached
+        if cached is not None and time.time() < cached[2]:
+            return cached[0], cached[1], "live"
+        if time.time() < _failed_until:
+            return _fallback(cached)
+
+        try:
+            r = _HTTP.request("GET", OPENSKY_URL, timeout=timeout)
+            if r.status != 200:
+                raise RuntimeError(f"HTTP {r.status}")
+            data = compact_states(orjson.loads(r.data))
+            index = build_icao24_index(data)
+            _cached = (data, index, _cache_expiry(data, time.time()))
+            return data, index, "live"
+
+        except Exception as e:
+            # しばらくは再取得せずフォールバックを返す（待っていたリクエストも含む）
+            _failed_until = time.time() + FAILURE_BACKOFF_SEC
+            result = _fallback(cached)
+            logger.warning("OpenSky failed -> %s fallback: %s: %s", result[2], type(e).__name__, e)
+            return result
+
+# state（compact_states の並び）をレスポンス用のdictに変換
+def state_to_dict(s: tuple) -> dict:
+    return {
+        "icao24": s[0],
+        "callsign": (s[1] or "").strip(),
+        "origin_country": s[2],
+        "time_position": s[3],
+        "last_contact": s[4],
+        "longitude": s[5],
+        "latitude": s[6],
+        "baro_altitude": s[7],
+        "geo_altitude": s[12],
+        "on_ground": bool(s[8]) if s[8] is not None else None,
+        "velocity": s[9],
+        "heading": s[10],
+        "vertical_rate": s[11],
+    }
 
 # states配列をlistに変換
 def to_plane_list(data: dict, limit: int = 200) -> list[dict]:
     states = data.get("states") or []
     result = []
     for s in states:
-        # [icao24, callsign, origin_country, time_position, last_contact, lon, lat, baro_altitude, on_ground, velocity, heading, vertical_rate, ...]
-        callsign = (s[1] or "").strip()
-        if not callsign:
+        if not (s[1] or "").strip():
             continue
 
-        result.append(
-            {
-                "icao24": s[0],
-                "callsign": callsign,
-                "origin_country": s[2],
-                "time_position": s[3],
-                "last_contact": s[4],
-                "longitude": s[5],
-                "latitude": s[6],
-                "baro_altitude": s[7],
-                "geo_altitude": s[13],
-                "on_ground": bool(s[8]) if s[8] is not None else None,
-                "velocity": s[9],
-                "heading": s[10],
-                "vertical_rate": s[11],
-            }
-        )
+        result.append(state_to_dict(s))
         if len(result) >= limit:
             break
     return result
 
 
-def find_by_icao24(data: dict, icao24: str) -> dict | None:
+def find_by_icao24(index: dict[str, tuple], icao24: str) -> dict | None:
     target = (icao24 or "").strip().lower()
     if not target:
         return None
 
-    states = data.get("states") or []
-    for s in states:
-        if (s[0] or "").lower() == target:
-            callsign = (s[1] or "").strip()
-            return {
-                "icao24": s[0],
-                "callsign": callsign,
-                "origin_country": s[2],
-                "time_position": s[3],
-                "last_contact": s[4],
-                "longitude": s[5],
-                "latitude": s[6],
-                "baro_altitude": s[7],
-                "on_ground": bool(s[8]) if s[8] is not None else None,
-                "velocity": s[9],
-                "heading": s[10],
-                "vertical_rate": s[11],
-            }
-    return None
+    s = index.get(target)
+    if s is None:
+        return None
+
+    # /track は従来どおり geo_altitude を返さない
+    hit = state_to_dict(s)
+    del hit["geo_altitude"]
+    return hit
 
 
 def lambda_handler(event, context):
@@ -142,23 +244,22 @@ def lambda_handler(event, context):
 
         # ルートはUI（static/index.html）を返す
         if path == "/":
-            if INDEX_PATH.exists():
-                return _resp_html(200, INDEX_PATH.read_text(encoding="utf-8"))
-            return _resp_html(200, "<h1>Flight Tracker</h1><p>static/index.html not found</p>")
+            return _resp_html(200, _INDEX_HTML, cache_control=_INDEX_CACHE_CONTROL)
 
         # planes / track は OpenSky or snapshot
-        data, source = fetch_opensky_or_snapshot()
+        data, index, source = fetch_opensky_or_snapshot()
 
         if path == "/planes":
             planes = to_plane_list(data, limit=200)
-            return _resp_json(200, {"source": source, "count": len(planes), "planes": planes})
+            return _resp_json(200, {"source": source, "count": len(planes), "planes": planes},
+                              cache_control=_states_cache_control(source))
 
         if path == "/track":
             icao24 = qs.get("icao24")
-            hit = find_by_icao24(data, icao24)
+            hit = find_by_icao24(index, icao24)
             if not hit:
                 return _resp_json(404, {"source": source, "error": "not found", "icao24": icao24})
-            return _resp_json(200, {"source": source, **hit})
+            return _resp_json(200, {"source": source, **hit}, cache_control=_states_cache_control(source))
 
         return _resp_json(404, {"error": "not found", "path": path})
 